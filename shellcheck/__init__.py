@@ -1,19 +1,28 @@
 # ex:ts=4:et:
 
+import concurrent.futures
+import dataclasses
 import enum
 import functools
 import gi
+import hashlib
 import json
-import subprocess
-import tempfile
 import warnings
 
+from typing import Optional
+
+try:
+    # orjson is considerably faster on large outputs, but optional
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 from .gutterrenderer import GutterRenderer
 
 gi.require_version('Gedit', '3.0')
 gi.require_version('Gtk', '3.0')
 
-from gi.repository import GObject, Gedit, GLib, GtkSource, Gtk, Pango, PeasGtk, Gio  # noqa
+from gi.repository import GObject, Gedit, Gdk, GLib, GtkSource, Gtk, Pango, PeasGtk, Gio  # noqa
 
 
 @enum.unique
@@ -26,10 +35,7 @@ class Level(enum.Enum):
     UNKNOWN = ("?", "#c64600")
     
     def __lt__(self, other):
-        members = list(type(self).__members__.values())
-        a = members.index(self)
-        b = members.index(other)
-        return a < b
+        return Level._ORDER[self] < Level._ORDER[other]
     
     @classmethod
     def by_code(clz, code):
@@ -47,6 +53,72 @@ class Level(enum.Enum):
         return self.value[1]
 
 
+Level._ORDER = {level: i for i, level in enumerate(Level.__members__.values())}
+
+
+def _parse_rgba(color):
+    rgba = Gdk.RGBA()
+    rgba.parse(color)
+    return rgba
+
+
+LEVEL_RGBA = {level: _parse_rgba(level.color) for level in Level}
+
+
+@dataclasses.dataclass(frozen=True, slots=True, eq=False)
+class Comment:
+    file: str
+    line: int
+    endLine: int
+    column: int
+    endColumn: int
+    level: Level
+    code: int
+    message: str
+    fix: Optional[dict]
+    
+    @classmethod
+    def from_json(clz, comment: dict) -> "Comment":
+        return clz(
+            file=comment["file"],
+            line=comment["line"],
+            endLine=comment["endLine"],
+            column=comment["column"],
+            endColumn=comment["endColumn"],
+            level=Level.by_code(comment["level"]),
+            code=comment["code"],
+            message=comment["message"],
+            fix=comment["fix"],
+        )
+
+
+def parse_shellcheck(output: bytes):
+    "parses json1 output into comments, line index, line colors and annotated range; runs on a worker thread"
+    
+    try:
+        data = json_loads(output)
+    except json.decoder.JSONDecodeError:
+        return None
+    
+    comments = [Comment.from_json(comment) for comment in data["comments"]]
+    
+    line_index = {}
+    for comment in comments:
+        if comment.file != "-":
+            continue
+        for line in range(comment.line, comment.endLine + 1):
+            line_index.setdefault(line, []).append(comment)
+    
+    line_color = {
+        line: LEVEL_RGBA[max(m.level for m in messages)]
+        for line, messages
+        in line_index.items()
+    }
+    
+    annotated_lines = (min(line_index), max(line_index)) if line_index else None
+    return comments, line_index, line_color, annotated_lines
+
+
 class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
     view = GObject.Property(type=Gedit.View)
     
@@ -54,13 +126,23 @@ class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
         super().__init__()
         
         self.context_data = {}
+        self.line_index = {}
+        self.line_color = {}
+        self.annotated_lines = None
         self.update_timeout = 0
-        self.parse_signal = 0
+        self.cancellable = None
+        self.last_text_hash = None
+        self.last_output_hash = None
+        self.last_change_time = 0
+        self.change_interval = 0
         self.connected = False
         self.location = None
         self.project_folder = None
     
     def do_activate(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # shellcheck can only check one document per process, but the launcher can be shared between runs
+        self.launcher = Gio.SubprocessLauncher.new(Gio.SubprocessFlags.STDIN_PIPE | Gio.SubprocessFlags.STDOUT_PIPE)
         self.gutter_renderer = GutterRenderer(self)
         self.gutter = self.view.get_gutter(Gtk.TextWindowType.LEFT)
         
@@ -76,15 +158,17 @@ class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
     def do_deactivate(self):
         if self.update_timeout != 0:
             GLib.source_remove(self.update_timeout)
-        if self.parse_signal != 0:
-            GLib.source_remove(self.parse_signal)
-            self.parse_signal = 0
+            self.update_timeout = 0
+        if self.cancellable:
+            self.cancellable.cancel()
+            self.cancellable = None
         
         self.disconnect_buffer()
         self.buffer = None
         
         self.disconnect_view()
         self.gutter.remove(self.gutter_renderer)
+        self.executor.shutdown(wait=False)
     
     def disconnect(self, obj, signals):
         for sid in signals:
@@ -101,9 +185,10 @@ class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
     def on_notify_buffer(self, view, gspec=None):
         if self.update_timeout != 0:
             GLib.source_remove(self.update_timeout)
-        if self.parse_signal != 0:
-            GLib.source_remove(self.parse_signal)
-            self.parse_signal = 0
+            self.update_timeout = 0
+        if self.cancellable:
+            self.cancellable.cancel()
+            self.cancellable = None
         
         if self.buffer:
             self.disconnect_buffer()
@@ -141,6 +226,8 @@ class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
             self.disconnect_gutter()
         else:
             self.connect_gutter()
+            # Files the script sources may have changed, so check again even if the text did not
+            self.last_text_hash = None
             self.update()
     
     def find_project_folder(self):
@@ -162,98 +249,127 @@ class ShellCheckViewActivatable(GObject.Object, Gedit.ViewActivatable):
             return
         
         self.gutter.insert(self.gutter_renderer, 60)
-        self.buffer_signals.append(self.buffer.connect('changed', self.update))
+        self.buffer_signals.append(self.buffer.connect('changed', self.on_changed))
         self.connected = True
     
+    def on_changed(self, buffer):
+        now = GLib.get_monotonic_time()
+        self.change_interval = now - self.last_change_time
+        self.last_change_time = now
+        
+        # The note and fix previews in cached tooltips show the old text
+        self.gutter_renderer.clear_tooltips()
+        self.update()
+    
     def update(self, *unused):
         if not self.connected:
             return
         
-        # We don't let the delay accumulate
+        # Restart the delay on every change, so we only check once the edits settle
         if self.update_timeout != 0:
-            return
-        if self.parse_signal != 0:
-            GLib.source_remove(self.parse_signal)
-            self.parse_signal = 0
+            GLib.source_remove(self.update_timeout)
+            self.update_timeout = 0
+        if self.cancellable:
+            self.cancellable.cancel()
+            self.cancellable = None
         
         # Do the initial diff without a delay
-        if not self.context_data:
+        if self.last_text_hash is None:
             self.on_update_timeout()
         else:
+            # Wait longer while the user is typing quickly, and for larger files
+            typing_delay = max(200, 500 - self.change_interval // 1000)
             n_lines = self.buffer.get_line_count()
-            delay = min(10000, 200 * (n_lines // 2000 + 1))
+            delay = min(10000, typing_delay * (n_lines // 2000 + 1))
             
             self.update_timeout = GLib.timeout_add(delay, self.on_update_timeout)
     
+    def get_buffer_bytes(self) -> bytes:
+        start, end = self.buffer.get_bounds()
+        return self.buffer.get_text(start, end, True).encode("utf-8")
+    
     def on_update_timeout(self):
         self.update_timeout = 0
-        if self.parse_signal != 0:
-            GLib.source_remove(self.parse_signal)
-            self.parse_signal = 0
+        if self.cancellable:
+            self.cancellable.cancel()
+            self.cancellable = None
         
         if not self.buffer:
             self.context_data = {}
+            self.line_index = {}
+            self.line_color = {}
+            self.annotated_lines = None
+            self.last_output_hash = None
         
         if not self.project_folder:
             return
         
-        text = self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), True)
-        
-        with tempfile.TemporaryFile("w+t") as fd:
-            fd.write(text)
-            fd.flush()
-            fd.seek(0)
-            
-            args = [
-                "shellcheck",
-                "--check-sourced",
-                "-f", "json1",
-                "-",
-            ]
-            try:
-                proc = subprocess.Popen(
-                    args,
-                    cwd=self.project_folder.get_path(),
-                    stdin=fd,
-                    stdout=subprocess.PIPE,
-                    universal_newlines=True,
-                )
-            except FileNotFoundError as e:
-                warnings.warn("shellcheck could not be found in $PATH: " + str(e))
-                return
-        
-        data = ""
+        text = self.get_buffer_bytes()
+        text_hash = hashlib.blake2b(text, digest_size=16).digest()
+        if text_hash == self.last_text_hash:
+            return
         
-        def on_read(stdout, flags, proc):
-            nonlocal data
-            
-            data += stdout.read(4096)
-            if not (flags & GLib.IO_HUP):
-                return True
-            
-            try:
-                proc.wait(timeout=0.5)
-            except subprocess.TimeoutExpired:
-                return True
-            
-            data += stdout.read()
-            self.parse_shellcheck(data)
-            self.parse_signal = 0
-            return False
+        args = [
+            "shellcheck",
+            "--check-sourced",
+            "-f", "json1",
+            "-",
+        ]
+        self.launcher.set_cwd(self.project_folder.get_path())
+        try:
+            proc = self.launcher.spawnv(args)
+        except GLib.Error as e:
+            warnings.warn("shellcheck could not be started: " + e.message)
+            return
         
-        self.parse_signal = GLib.io_add_watch(proc.stdout, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, on_read, proc)
+        self.cancellable = Gio.Cancellable()
+        proc.communicate_async(
+            GLib.Bytes.new(text), self.cancellable, self.on_shellcheck_finished, (self.cancellable, text_hash),
+        )
     
-    def parse_shellcheck(self, output: str):
+    def on_shellcheck_finished(self, proc, result, user_data):
+        cancellable, text_hash = user_data
+        
         try:
-            data = json.loads(output)
-        except json.decoder.JSONDecodeError:
+            _, stdout, _ = proc.communicate_finish(result)
+        except GLib.Error as e:
+            proc.force_exit()
+            if not e.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                warnings.warn("shellcheck failed: " + e.message)
+            return
+        
+        # A newer run has superseded this one
+        if cancellable is not self.cancellable:
             return
         
-        comments = data["comments"]
+        output = stdout.get_data() if stdout else b""
+        output_hash = hashlib.blake2b(output, digest_size=8).digest()
         
-        for comment in comments:
-            comment["levelcls"] = Level.by_code(comment["level"])
+        # Small edits often leave the messages as they were, so there is nothing to rebuild or redraw
+        if output_hash == self.last_output_hash:
+            self.cancellable = None
+            self.last_text_hash = text_hash
+            # The line previews may still have changed
+            self.gutter_renderer.clear_tooltips()
+            return
         
-        self.context_data = comments
+        # Parsing large outputs takes a while, so keep it off the main loop
+        future = self.executor.submit(parse_shellcheck, output)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self.apply_shellcheck, future, cancellable, text_hash, output_hash)
+        )
+    
+    def apply_shellcheck(self, future, cancellable, text_hash, output_hash):
+        if cancellable.is_cancelled() or cancellable is not self.cancellable:
+            return False
+        self.cancellable = None
+        
+        result = future.result()
+        if result is None:
+            return False
+        
+        self.context_data, self.line_index, self.line_color, self.annotated_lines = result
+        self.last_text_hash = text_hash
+        self.last_output_hash = output_hash
         self.gutter_renderer.update()
-
+        return False
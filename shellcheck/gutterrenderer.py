@@ -1,32 +1,19 @@
 # ex:ts=4:et:
 
-import dataclasses
-import re
-from gi.repository import Gdk, GLib, Gtk, GtkSource
+import collections
+from gi.repository import Gdk, GLib, GtkSource
 from typing import List, Tuple
 
-TOOLTIP_TEMPLATE = re.sub(r"\s+", " ", """
-    {line}<span foreground="#008899">:</span>{column}<span foreground="#008899">:</span>
-    <b>SC{code} <span foreground="{c}">({level})</span>:</b> {escapedmsg}
-""".strip())
 
+def format_tooltip_header(line: int, column: int, code: int, color: str, level: str, escapedmsg: str) -> str:
+    return (
+        f'{line}<span foreground="#008899">:</span>{column}<span foreground="#008899">:</span> '
+        f'<b>SC{code} <span foreground="{color}">({level})</span>:</b> {escapedmsg}'
+    )
 
-@dataclasses.dataclass
-class Replacement:
-    line: int
-    endLine: int
-    column: int
-    endColumn: int
-    start: Gtk.TextMark
-    end: Gtk.TextMark
-    text: str
-    
-    def get_range(self, buf: Gtk.TextBuffer) -> Tuple[int, int]:
-        start = buf.get_iter_at_mark(self.start).get_offset()
-        end = buf.get_iter_at_mark(self.end).get_offset()
-        if start > end:
-            start, end = end, start
-        return start, end
+
+# Number of lines whose tooltip markup is kept around
+TOOLTIP_CACHE_SIZE = 64
 
 
 class GutterRenderer(GtkSource.GutterRenderer):
@@ -34,38 +21,29 @@ class GutterRenderer(GtkSource.GutterRenderer):
         GtkSource.GutterRenderer.__init__(self)
         
         self.view = view
+        self.tooltip_cache = collections.OrderedDict()
         
         self.set_size(8)
         # self.set_padding(3, 0)
     
     def get_messages_in_range(self, line: int):
-        return [
-            msg
-            for msg
-            in self.view.context_data
-            if (
-                msg["file"] == "-"
-                and line >= msg["line"]
-                and line <= msg["endLine"]
-            )
-         ]
+        return self.view.line_index.get(line, ())
     
     def do_draw(self, cr, bg_area, cell_area, start, end, state):
         GtkSource.GutterRenderer.do_draw(self, cr, bg_area, cell_area, start, end, state)
         
         line = start.get_line() + 1
         
-        if not self.view.context_data:
+        if self.view.annotated_lines is None:
             return
-        
-        messages = self.get_messages_in_range(line)
-        if not messages:
+        first, last = self.view.annotated_lines
+        if not (first <= line <= last):
             return
         
-        level = max(m["levelcls"] for m in messages)
+        background = self.view.line_color.get(line)
+        if background is None:
+            return
         
-        background = Gdk.RGBA()
-        background.parse(level.color)
         Gdk.cairo_set_source_rgba(cr, background)
         cr.rectangle(cell_area.x, cell_area.y, cell_area.width, cell_area.height)
         cr.fill()
@@ -76,6 +54,12 @@ class GutterRenderer(GtkSource.GutterRenderer):
         if not self.view.context_data:
             return False
         
+        markup = self.tooltip_cache.get(line_no)
+        if markup is not None:
+            self.tooltip_cache.move_to_end(line_no)
+            tooltip.set_markup(markup)
+            return True
+        
         messages = self.get_messages_in_range(line_no)
         if not messages:
             return False
@@ -90,29 +74,44 @@ class GutterRenderer(GtkSource.GutterRenderer):
             in messages
         )
         
-        tooltip.set_markup(f'<span font="monospace">{text}</span>')
+        markup = f'<span font="monospace">{text}</span>'
+        self.tooltip_cache[line_no] = markup
+        if len(self.tooltip_cache) > TOOLTIP_CACHE_SIZE:
+            self.tooltip_cache.popitem(last=False)
+        
+        tooltip.set_markup(markup)
         return True
     
     def format_message(self, message, line_no: int, line: str) -> str:
-        content = TOOLTIP_TEMPLATE.format(
-            c=message["levelcls"].color,
-            escapedmsg=GLib.markup_escape_text(message["message"]),
-            **message,
+        content = format_tooltip_header(
+            message.line,
+            message.column,
+            message.code,
+            message.level.color,
+            message.level.code,
+            GLib.markup_escape_text(message.message),
         )
         
-        content += self.preview_note(message)
+        content += self.preview_note(message, line_no, line)
         content += self.preview_fix(message)
         return content
     
-    def preview_note(self, message) -> str:
-        note_start = self.view.buffer.get_iter_at_line_offset(message["line"] - 1, message["column"] - 1)
-        note_end = self.view.buffer.get_iter_at_line_offset(message["endLine"] - 1, message["endColumn"] - 1)
-        line_start = self.view.buffer.get_iter_at_line(message["line"] - 1)
-        line_end = self.view.buffer.get_iter_at_line(message["endLine"])
-        
-        prefix = self.view.buffer.get_text(line_start, note_start, True)
-        error = self.view.buffer.get_text(note_start, note_end, True)
-        suffix = self.view.buffer.get_text(note_end, line_end, True).rstrip("\n")
+    def preview_note(self, message, line_no: int, line: str) -> str:
+        # The hovered line is already at hand; only multi-line notes need another lookup
+        if message.line == message.endLine == line_no:
+            text = line
+        else:
+            buf = self.view.buffer
+            text = buf.get_text(buf.get_iter_at_line(message.line - 1), buf.get_iter_at_line(message.endLine), True)
+        
+        start = message.column - 1
+        end = message.endColumn - 1
+        if message.endLine > message.line:
+            end += sum(len(part) + 1 for part in text.split("\n")[:message.endLine - message.line])
+        
+        prefix = text[:start]
+        error = text[start:end]
+        suffix = text[end:].rstrip("\n")
         
         return (
             f'\n<span foreground="#999" background="#222">'
@@ -123,64 +122,59 @@ class GutterRenderer(GtkSource.GutterRenderer):
         )
     
     def preview_fix(self, message) -> str:
-        if not message["fix"]:
+        if not message.fix:
             return ""
-        if not message["fix"]["replacements"]:
+        if not message.fix["replacements"]:
             return ""
         
-        buf = Gtk.TextBuffer()
-        buf.set_text(self.view.buffer.get_text(
-            self.view.buffer.get_start_iter(),
-            self.view.buffer.get_end_iter(),
-            True,
-        ))
-        
-        replacements = []
-        for item in message["fix"]["replacements"]:
-            s = buf.create_mark(
-                None,
-                buf.get_iter_at_line_offset(item["line"] - 1, item["column"] - 1),
-                True,
-            )
-            e = buf.create_mark(
-                None,
-                buf.get_iter_at_line_offset(item["endLine"] - 1, item["endColumn"] - 1),
-                False,
-            )
-            replacements.append(Replacement(
-                item["line"], item["endLine"],
-                item["column"], item["endColumn"],
-                s, e,
-                item["replacement"],
-            ))
-        
-        for replacement in replacements:
-            buf.delete(buf.get_iter_at_mark(replacement.start), buf.get_iter_at_mark(replacement.end))
-            buf.insert(buf.get_iter_at_mark(replacement.start), replacement.text)
-        
-        inserted_ranges = [
-            replacement.get_range(buf)
-            for replacement
-            in replacements
-        ]
+        replacements = message.fix["replacements"]
+        
+        # Only the lines touched by the message and its fix are needed for the preview
+        first_line = min(message.line, *(item["line"] for item in replacements)) - 1
+        last_line = max(message.endLine, *(item["endLine"] for item in replacements))
+        
+        buf = self.view.buffer
+        text = buf.get_text(buf.get_iter_at_line(first_line), buf.get_iter_at_line(last_line), True)
+        
+        line_offsets = [0]
+        for line in text.split("\n"):
+            line_offsets.append(line_offsets[-1] + len(line) + 1)
+        
+        def get_offset(line: int, column: int) -> int:
+            return min(line_offsets[line - 1 - first_line] + column - 1, len(text))
+        
+        edits = []
+        for item in replacements:
+            start = get_offset(item["line"], item["column"])
+            end = get_offset(item["endLine"], item["endColumn"])
+            if start > end:
+                start, end = end, start
+            edits.append((start, end, item["replacement"]))
+        edits.sort()
+        
+        # Apply right to left, so the offsets of the remaining edits stay valid
+        for start, end, replacement in reversed(edits):
+            text = text[:start] + replacement + text[end:]
+        
+        inserted_ranges = []
+        delta = 0
+        for start, end, replacement in edits:
+            inserted_ranges.append((start + delta, start + delta + len(replacement)))
+            delta += len(replacement) - (end - start)
         inserted_ranges = self.merge_ranges(inserted_ranges)
         
-        pos = buf.get_iter_at_line(message["line"] - 1)
+        pos = 0
         content = ""
         
         for start, end in inserted_ranges:
-            start_it = buf.get_iter_at_offset(start)
-            end_it = buf.get_iter_at_offset(end)
-            
-            prefix = GLib.markup_escape_text(buf.get_text(pos, start_it, True))
-            fix = GLib.markup_escape_text(buf.get_text(start_it, end_it, True))
+            prefix = GLib.markup_escape_text(text[pos:start])
+            fix = GLib.markup_escape_text(text[start:end])
             
-            pos = end_it
+            pos = end
             
             content += f'{prefix}<span foreground="#0F0">{fix}</span>'
         
-        end_it = buf.get_iter_at_line(message["endLine"])
-        suffix = GLib.markup_escape_text(buf.get_text(pos, end_it, True)).rstrip("\n")
+        suffix = GLib.markup_escape_text(text[pos:]).rstrip("\n")
         
         return (
             f'\n<span foreground="#0F0">Did you mean:</span>'
@@ -193,19 +187,22 @@ class GutterRenderer(GtkSource.GutterRenderer):
     def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
         "merges a list of text ranges and sorts them"
         
-        ranges = sorted(ranges)
+        if len(ranges) < 2:
+            return list(ranges)
         
-        new_ranges = [ranges[0]]
-        for r in ranges:
-            start, end = r
-            
-            if start >= new_ranges[-1][0] and start <= new_ranges[-1][1] and end >= new_ranges[-1][1]:
-                new_ranges[-1] = (new_ranges[-1][0], end)
+        new_ranges = []
+        for start, end in sorted(ranges):
+            if new_ranges and start <= new_ranges[-1][1]:
+                new_ranges[-1] = (new_ranges[-1][0], max(new_ranges[-1][1], end))
             else:
                 new_ranges.append((start, end))
         
         return new_ranges
     
+    def clear_tooltips(self):
+        self.tooltip_cache.clear()
+    
     def update(self):
+        self.clear_tooltips()
         self.queue_draw()
 